@@ -8,6 +8,10 @@
 # Prerequisites:
 # pip install numpy-stl
 #
+# Optional:
+# pip install numba
+# Very large binary STLs are then rotated on all CPU cores.
+#
 # Tool: 
 # ChatGPT (GPT-4)
 #
@@ -18,28 +22,131 @@
 # 3. Save the model by adding "_rotated" to the end of the original filename
 
 import os
+from concurrent.futures import ProcessPoolExecutor
 from stl import mesh
 import numpy as np
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# 90 degrees about the X axis followed by 180 degrees about the Y axis, folded into
+# a single matrix. numpy-stl rotates clockwise for positive angles, so this matches
+# what the two mesh.rotate() calls used to produce.
+ROTATION = np.array([[-1, 0, 0],
+                     [0, 0, 1],
+                     [0, 1, 0]], dtype=np.float32)
+
+# Vertices are stored as row vectors, so they are rotated as "points @ ROTATION.T".
+# The transpose is taken once here rather than on every call.
+ROTATION_T = np.ascontiguousarray(ROTATION.T)
+
+# Binary STL layout: an 80-byte header, a little-endian uint32 triangle count, then
+# one 50-byte record per triangle.
+STL_HEADER_SIZE = 84
+STL_RECORD = np.dtype([('normal', '<f4', (3,)),
+                       ('vectors', '<f4', (3, 3)),
+                       ('attr', '<u2')])
+
+# Binary STLs with at least this many triangles are rotated with the Numba kernel
+# when Numba is installed. Smaller meshes aren't worth the compile time.
+NUMBA_MIN_TRIANGLES = 1_000_000
+
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def rotate_points(source, target, rotation):
+        # source and target have shape (triangles, points, 3)
+        for i in numba.prange(source.shape[0]):
+            for j in range(source.shape[1]):
+                x = source[i, j, 0]
+                y = source[i, j, 1]
+                z = source[i, j, 2]
+                for k in range(3):
+                    target[i, j, k] = rotation[k, 0] * x + rotation[k, 1] * y + rotation[k, 2] * z
+
+def read_binary_header(input_path):
+    # Return the 84-byte header and triangle count if the file is a binary STL,
+    # or None if it looks like an ASCII STL. ASCII files may also start with
+    # "solid", so the file size is the reliable test.
+    with open(input_path, 'rb') as f:
+        header = f.read(STL_HEADER_SIZE)
+    if len(header) < STL_HEADER_SIZE:
+        return None
+    count = int(np.frombuffer(header, dtype='<u4', offset=80)[0])
+    if os.path.getsize(input_path) != STL_HEADER_SIZE + count * STL_RECORD.itemsize:
+        return None
+    return header, count
+
 def rotate_model(input_path, output_path):
-    # Load the STL model
-    main_mesh = mesh.Mesh.from_file(input_path)
+    binary_header = read_binary_header(input_path)
+
+    # ASCII STLs go through numpy-stl
+    if binary_header is None:
+        main_mesh = mesh.Mesh.from_file(input_path)
+        main_mesh.vectors[:] = main_mesh.vectors @ ROTATION_T
+        main_mesh.normals[:] = main_mesh.normals @ ROTATION_T
+        main_mesh.save(output_path)
+        return
+
+    # Binary STLs are rotated straight from one memory-mapped file into another,
+    # without parsing the triangles into Python objects or re-serializing them
+    header, count = binary_header
+    file_size = STL_HEADER_SIZE + count * STL_RECORD.itemsize
+    with open(output_path, 'wb') as f:
+        f.write(header)
+        # Reserve the whole file up front so the filesystem can allocate it in one
+        # contiguous extent instead of growing it page by page while it's written
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(f.fileno(), 0, file_size)
+        else:
+            f.truncate(file_size)
+    if count == 0:
+        return
 
-    # Rotate 90 degrees about the X axis
-    main_mesh.rotate([1, 0, 0], np.radians(90))
+    source = np.memmap(input_path, dtype=STL_RECORD, mode='r', offset=STL_HEADER_SIZE, shape=(count,))
+    target = np.memmap(output_path, dtype=STL_RECORD, mode='r+', offset=STL_HEADER_SIZE, shape=(count,))
 
-    # Rotate 180 degrees about the Y axis
-    main_mesh.rotate([0, 1, 0], np.radians(180))
+    # Rotate 90 degrees about the X axis and 180 degrees about the Y axis in one pass
+    if numba is not None and count >= NUMBA_MIN_TRIANGLES:
+        rotate_points(source['vectors'], target['vectors'], ROTATION)
+        rotate_points(source['normal'][:, np.newaxis], target['normal'][:, np.newaxis], ROTATION)
+    else:
+        target['vectors'] = source['vectors'] @ ROTATION_T
+        target['normal'] = source['normal'] @ ROTATION_T
+    target['attr'] = source['attr']
+    target.flush()
+    del source, target
 
-    # Save the rotated model
-    main_mesh.save(output_path)
+def init_worker(thread_count):
+    # Share the cores between the worker processes instead of every worker's
+    # Numba kernel trying to use all of them
+    if numba is not None:
+        numba.set_num_threads(thread_count)
+
+def rotate_file(paths):
+    input_path, output_path = paths
+    rotate_model(input_path, output_path)
+    return os.path.basename(input_path)
 
 def process_directory(directory_path):
-    for filename in os.listdir(directory_path):
-        if filename.endswith('.stl') or filename.endswith('.STL'):
-            input_file_path = os.path.join(directory_path, filename)
-            output_file_path = os.path.join(directory_path, filename.replace('.stl', '_rotated.stl').replace('.STL', '_rotated.STL'))
-            rotate_model(input_file_path, output_file_path)
+    jobs = []
+    with os.scandir(directory_path) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.lower().endswith('.stl'):
+                base, ext = os.path.splitext(entry.path)
+                jobs.append((entry.path, base + '_rotated' + ext))
+
+    if not jobs:
+        return
+
+    # Each file is independent, so rotate them in separate processes. Don't start
+    # more workers than there are files to process.
+    cpu_count = os.cpu_count() or 1
+    max_workers = min(cpu_count, len(jobs))
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker,
+                             initargs=(max(1, cpu_count // max_workers),)) as executor:
+        for filename in executor.map(rotate_file, jobs, chunksize=1):
             print(f"Processed: {filename}")
 
 if __name__ == "__main__":
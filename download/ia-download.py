@@ -13,24 +13,41 @@
 # Example: (downloads all MP4 files from Season 03 of the Computer Chronicles)
 #   ia-download.py https://archive.org/download/Computer_Chronicles/Season%2003/ mp4
 #
+#   Files are downloaded to a ".part" file and renamed when complete. Running the
+#   script again skips files that are already complete and resumes partial ones.
+#   Large files downloaded in parts also keep a ".part.parts" file listing the
+#   parts that are finished, so only the missing parts are downloaded again.
+#
 # Prerequisites:
-#   BeautifulSoup
-#   pip install beautifulsoup4
-#   
 #   TQDM
 #   pip install tqdm
 #
+#   Optional: httpx with HTTP/2 support, used for the folder listing and small files
+#   pip install httpx[http2]
+#
 # Tool: 
 #   ChatGPT (GPT-4)
 
+import contextlib
+import functools
+import html
 import os
+import re
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 import sys
+import threading
+import time
 import urllib.parse
 
+try:
+    import httpx
+    import h2  # needed for httpx's HTTP/2 support
+except ImportError:
+    httpx = None
+
 # Get the URL from the command-line arguments
 if len(sys.argv) < 2:
     print('Please specify the URL of the archive.org folder.')
@@ -41,15 +58,105 @@ url = sys.argv[1]
 file_type = '.zip'
 if len(sys.argv) >= 3:
     file_type = '.' + sys.argv[2] if not sys.argv[2].startswith('.') else sys.argv[2]
+file_type = file_type.lower()
 
-# Request the HTML content of the page
-response = requests.get(url)
+# Number of files to download at the same time. The concurrency controller below
+# starts at initial_workers and adjusts between min_workers and max_workers based
+# on the measured throughput.
+initial_workers = 10
+min_workers = 1
+max_workers = 32
+control_interval = 5  # seconds between throughput measurements
+retry_delay = 5  # seconds to wait before retrying a throttled request
+max_retries = 10  # give up on a file after this many throttled retries
+
+# Files at least this big are split into part_size pieces, which are downloaded
+# part_count at a time over separate connections to get more out of fast links
+multipart_min_size = 64 * 1024 * 1024
+part_size = 16 * 1024 * 1024
+part_count = 4
+
+# Limits the number of active downloads, and every control_interval seconds compares
+# the aggregate throughput with the previous interval: if it improved by 10% or more
+# while every slot was busy, one more download is allowed; if it dropped by 10% or
+# more, or the server asks us to slow down (HTTP 429/503), the limit is halved.
+class ConcurrencyController:
+    def __init__(self, initial, minimum, maximum, interval):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.interval = interval
+        self.active = 0
+        self.bytes_received = 0
+        self.last_rate = None  # no baseline until the first measurement
+        self.condition = threading.Condition()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def __enter__(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def __exit__(self, *exc_info):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def add_bytes(self, count):
+        with self.condition:
+            self.bytes_received += count
 
-# Parse the HTML content using BeautifulSoup
-soup = BeautifulSoup(response.content, 'html.parser')
+    def throttled(self):
+        with self.condition:
+            self.limit = max(self.minimum, self.limit // 2)
+            # Throughput after halving isn't comparable with before, so start over
+            # with a fresh baseline
+            self.last_rate = None
 
-# Find all links that end with the specified file type and do not have "View Contents" in their text
-file_links = soup.find_all('a', href=lambda href: href is not None and href.endswith(file_type) and 'View Contents' not in href)
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.condition:
+                rate = self.bytes_received / self.interval
+                self.bytes_received = 0
+                # Without a baseline (at startup, after being throttled, or after an
+                # interval where nothing arrived) this measurement only becomes the
+                # baseline; a zero rate is never an improvement
+                if self.last_rate:
+                    if rate > 0 and rate >= self.last_rate * 1.1 and self.active >= self.limit:
+                        self.limit = min(self.maximum, self.limit + 1)
+                        self.condition.notify()
+                    elif rate <= self.last_rate * 0.9:
+                        self.limit = max(self.minimum, self.limit // 2)
+                self.last_rate = rate
+
+# Share one session across all downloads so connections to archive.org are kept
+# alive and reused instead of doing a new TCP/TLS handshake for every file
+session = requests.Session()
+adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+session.mount('https://', adapter)
+session.mount('http://', adapter)
+
+# If httpx is installed with HTTP/2 support, the listing, the HEAD requests and files
+# smaller than multipart_min_size are multiplexed as streams over a shared HTTP/2
+# connection instead of each needing a connection of their own. Large files stay on
+# the requests session, where each part gets its own connection to fill the link.
+http2_client = None
+if httpx is not None:
+    http2_client = httpx.Client(http2=True, follow_redirects=True, timeout=None,
+                                limits=httpx.Limits(max_connections=max_workers, max_keepalive_connections=4))
+
+# Request the HTML content of the page
+response = http2_client.get(url) if http2_client else session.get(url)
+
+# Find all links that end with the specified file type, in any case (archive.org
+# items can have both .zip and .ZIP files). The listing is scanned with a regular
+# expression rather than parsed into a tree, which is much faster for folders with
+# thousands of files. "View Contents" links point at a folder (they end in "/"), so
+# they never match.
+link_pattern = re.compile(rf'href="([^"]*{re.escape(file_type)})"', re.IGNORECASE)
+file_links = [html.unescape(href) for href in link_pattern.findall(response.text)]
 
 # Create a directory to store the downloaded files
 download_dir = f'downloaded_{file_type[1:]}s'  # e.g., downloaded_zips or downloaded_pdfs
@@ -70,32 +177,167 @@ def download_file(file_url):
     filename = sanitize_filename(raw_filename)
     
     filepath = os.path.join(download_dir, filename)
-    with open(filepath, 'wb') as f:
-        download_and_write_file(f, file_url, filename)
+    part_path = filepath + '.part'
+
+    # Find out how big the file is and whether the server accepts range requests
+    if http2_client:
+        head = http2_client.head(file_url)
+    else:
+        head = session.head(file_url, allow_redirects=True)
+
+    # A throttled HEAD just leaves the size unknown; the GET below retries. Any other
+    # error (404, 403, 500...) fails this file rather than saving the error page.
+    if head.status_code in (429, 503):
+        total_size = 0
+        accepts_ranges = False
+    else:
+        head.raise_for_status()
+        total_size = int(head.headers.get('content-length', 0))
+        accepts_ranges = head.headers.get('accept-ranges') == 'bytes'
+    use_http2 = http2_client is not None and total_size < multipart_min_size
+
+    # Skip files that were already downloaded completely. A total_size of 0 means the
+    # size is unknown, so nothing can be assumed complete.
+    if total_size and os.path.exists(filepath) and os.path.getsize(filepath) == total_size:
+        print(f'{filename} already downloaded. Skipping...')
+        return
 
-def download_and_write_file(file_handle, file_url, filename):
-    response = requests.get(file_url, stream=True)
-    total_size = int(response.headers.get('content-length', 0))
-    block_size = 1024
     progress_bar = tqdm(total=total_size, unit='iB', unit_scale=True, desc=filename)
-    try:
-        for data in response.iter_content(block_size):
-            if tqdm._instances:
-                progress_bar.update(len(data))
-                file_handle.write(data)
+    downloaded = False
+
+    if total_size >= multipart_min_size and accepts_ranges:
+        downloaded = download_parts(str(head.url), part_path, total_size, progress_bar)
+    elif accepts_ranges and os.path.exists(part_path):
+        # Pick up where an interrupted download left off
+        existing_size = os.path.getsize(part_path)
+        progress_bar.update(existing_size)
+        if total_size and existing_size == total_size:
+            downloaded = True
+        else:
+            with open(part_path, 'ab') as f:
+                downloaded = download_and_write_file(f, file_url, progress_bar, {'Range': f'bytes={existing_size}-'}, use_http2)
+
+    if not downloaded:
+        with open(part_path, 'wb') as f:
+            download_and_write_file(f, file_url, progress_bar, use_http2=use_http2)
+
+    os.replace(part_path, filepath)
+
+# Download a file in several byte ranges at once, each written at its own offset.
+# Finished ranges are recorded in a ".parts" file next to it, so an interrupted
+# download only fetches the missing ranges when resumed. Returns False if the
+# server ignored the range requests.
+def download_parts(file_url, filepath, total_size, progress_bar):
+    parts_path = filepath + '.parts'
+    starts = range(0, total_size, part_size)
+    ranges = [(start, min(start + part_size, total_size) - 1) for start in starts]
+
+    finished = set()
+    if os.path.exists(parts_path) and os.path.exists(filepath) and os.path.getsize(filepath) == total_size:
+        with open(parts_path) as f:
+            finished = {tuple(int(n) for n in line.split('-')) for line in f if line.strip()}
+    else:
+        # Reserve the whole file up front so the parts can be written in any order
+        with open(filepath, 'wb') as f:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(f.fileno(), 0, total_size)
             else:
-                # Progress bar has been closed by user
-                break
+                f.truncate(total_size)
+        open(parts_path, 'w').close()
+
+    missing = [part for part in ranges if part not in finished]
+    progress_bar.update(total_size - sum(end - start + 1 for start, end in missing))
+
+    parts_lock = threading.Lock()
+    def download_and_record(part):
+        start, end = part
+        if not download_part(file_url, filepath, start, end, progress_bar):
+            return False
+        with parts_lock, open(parts_path, 'a') as f:
+            f.write(f'{start}-{end}\n')
+        return True
+
+    with ThreadPoolExecutor(max_workers=part_count) as part_executor:
+        results = list(part_executor.map(download_and_record, missing))
+
+    # The list is no longer needed once the file is complete, or if the server
+    # doesn't support ranges and the file has to be downloaded in one go
+    os.remove(parts_path)
+    return all(results)
+
+def download_part(file_url, filepath, start, end, progress_bar):
+    with open(filepath, 'r+b') as f:
+        f.seek(start)
+        return download_and_write_file(f, file_url, progress_bar, {'Range': f'bytes={start}-{end}'})
+
+# Send a streaming GET with either HTTP client, yielding the status code, the
+# response headers and an iterator over the body
+@contextlib.contextmanager
+def open_stream(file_url, headers, use_http2):
+    block_size = 1024 * 1024
+    if use_http2:
+        with http2_client.stream('GET', file_url, headers=headers) as response:
+            yield response.status_code, response.headers, response.iter_bytes(block_size)
+    else:
+        with session.get(file_url, stream=True, headers=headers) as response:
+            # Read straight from the underlying urllib3 response, the way shutil.copyfileobj
+            # does, rather than through the generators that iter_content wraps around it
+            response.raw.decode_content = True
+            yield response.status_code, response.headers, iter(functools.partial(response.raw.read, block_size), b'')
+
+def download_and_write_file(file_handle, file_url, progress_bar, headers=None, use_http2=False):
+    for attempt in range(max_retries + 1):
+        with controller:
+            with open_stream(file_url, headers, use_http2) as (status_code, response_headers, chunks):
+                if status_code not in (429, 503):
+                    # Any other error fails the file instead of saving the error page. A
+                    # 416 for a range request means the range doesn't fit the file, so
+                    # it's handled below like a server without range support.
+                    if status_code >= 400 and not (headers and status_code == 416):
+                        raise RuntimeError(f'Server returned HTTP {status_code}')
+                    # A range request answered with the whole file means ranges aren't supported
+                    if headers and status_code != 206:
+                        return False
+                    if not headers:
+                        progress_bar.reset(total=int(response_headers.get('content-length', 0)))
+                    write_chunks(file_handle, chunks, progress_bar)
+                    return True
+
+        # The server is throttling us, so back off before trying again
+        controller.throttled()
+        if attempt < max_retries:
+            time.sleep(retry_delay)
+
+    raise RuntimeError(f'Server is still throttling after {max_retries} retries (HTTP {status_code})')
+
+def write_chunks(file_handle, chunks, progress_bar):
+    try:
+        for data in chunks:
+            progress_bar.update(len(data))
+            file_handle.write(data)
+            controller.add_bytes(len(data))
     except KeyboardInterrupt:
         # User pressed the q key to quit
         progress_bar.close()
         print('\nDownload interrupted.')
         sys.exit()
 
-# Use multithreading to download the files
-with ThreadPoolExecutor(max_workers=10) as executor:
+# Use multithreading to download the files, letting the controller decide how many
+# of the threads are actually downloading at any time
+controller = ConcurrencyController(initial_workers, min_workers, max_workers, control_interval)
+with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    futures = {}
     for link in file_links:
-        file_url = url + link.get('href')
-        executor.submit(download_file, file_url)
+        file_url = url + link
+        futures[executor.submit(download_file, file_url)] = link
+
+# Report any files that couldn't be downloaded instead of silently skipping them
+failed = [(link, future.exception()) for future, link in futures.items() if future.exception()]
+for link, error in failed:
+    print(f'Failed to download {urllib.parse.unquote(link)}: {error}')
+
+if failed:
+    print(f'{len(failed)} of {len(futures)} {file_type[1:]} files could not be downloaded.')
+    sys.exit(1)
 
 print(f'All {file_type[1:]} files downloaded.')
\ No newline at end of file
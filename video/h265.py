@@ -24,6 +24,13 @@
 #   MKVToolNix must be installed https://mkvtoolnix.download/downloads.html
 #   - No matter which version you use, the binaries must be available in your PATH
 #
+# Hardware encoding:
+#   If HandBrake reports a hardware HEVC encoder (NVIDIA NVENC, Intel QuickSync or
+#   Apple VideoToolbox), it is used instead of x265, along with hardware decoding
+#   where HandBrake supports it. This is many times faster, but the quality setting
+#   means something different for each encoder, so file sizes and quality will not
+#   match x265 exactly. See ENCODER_OPTIONS below.
+#
 # Tool: 
 #   ChatGPT (GPT-4)
 #
@@ -62,18 +69,84 @@ import subprocess
 import sys
 import os
 import json
-from datetime import datetime
+import logging
+import queue
+import re
+import tempfile
+import threading
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from logging.handlers import QueueHandler, QueueListener
+
+
+# mkvmerge warnings and errors are written to this log file in the output folder
+LOG_FILENAME = 'mkvmerge-warnings-errors.log'
+log = logging.getLogger('mkvmerge')
+log.setLevel(logging.WARNING)
+log.propagate = False
+
+# Files with these extensions are transcoded
+VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.avi', '.mov', '.flv', '.wmv')
+
+# HEVC encoders in order of preference, with the HandBrake options for each. The
+# first one HandBrake reports as available is used. x265 and QSV take a constant
+# quality value where lower is better; NVENC takes a CQ value on a similar scale;
+# VideoToolbox takes a 0-100 quality value where higher is better.
+ENCODER_OPTIONS = {
+    "nvenc_h265": ["--encoder-preset", "slow", "-q", "22"],
+    "qsv_h265": ["--encoder-preset", "quality", "-q", "22"],
+    "vt_h265": ["-q", "60"],
+    "x265": ["--encoder-preset", "slow", "-q", "22"],
+}
+
+# Hardware decoders to pair with each hardware encoder
+HW_DECODERS = {
+    "nvenc_h265": "nvdec",
+    "qsv_h265": "qsv",
+}
+
+# Number of encodes to run at the same time with a hardware encoder. Consumer NVIDIA
+# cards limit the number of simultaneous NVENC sessions.
+HW_ENCODE_SESSIONS = {
+    "nvenc_h265": 3,
+}
+
+def detect_encoder():
+    result = subprocess.run(["HandBrakeCLI", "--help"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    help_text = result.stdout
 
+    for encoder in ENCODER_OPTIONS:
+        if re.search(rf"\b{encoder}\b", help_text):
+            options = list(ENCODER_OPTIONS[encoder])
+            if encoder in HW_DECODERS and "--enable-hw-decoding" in help_text:
+                options.extend(["--enable-hw-decoding", HW_DECODERS[encoder]])
+            return encoder, options
+
+    # Fall back to software x265 if the encoder list couldn't be read
+    return "x265", ENCODER_OPTIONS["x265"]
+
+def encode_worker_count(encoder):
+    if encoder == "x265":
+        # x265's slow preset only keeps about 8 threads busy, so on CPUs with more
+        # cores than that, run one encode per 8 cores
+        return max(1, (os.cpu_count() or 1) // 8)
+    return HW_ENCODE_SESSIONS.get(encoder, 1)
 
 def get_tracks_info(input_file):
     command = ["mkvmerge", "-J", input_file]
     result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     info = json.loads(result.stdout)
 
-    track_ids = {'video': [], 'audio': [], 'subtitles': []}
+    track_ids = {'video': [], 'audio': [], 'subtitles': [], 'video_codec': None, 'height': None}
     for track in info['tracks']:
         if track['type'] == 'video':
             track_ids['video'].append(str(track['id']))
+
+            # Remember the codec and height of the first video track, e.g. "HEVC/H.265/MPEG-H" and "1920x1080"
+            if track_ids['video_codec'] is None:
+                track_ids['video_codec'] = track.get('codec', '')
+                dimensions = track.get('properties', {}).get('pixel_dimensions', '')
+                if 'x' in dimensions:
+                    track_ids['height'] = int(dimensions.split('x')[1])
         elif track['type'] == 'audio':
             track_ids['audio'].append(str(track['id']))
         elif track['type'] == 'subtitles':
@@ -81,15 +154,14 @@ def get_tracks_info(input_file):
 
     return track_ids
 
-def encode_video(input_path, output_path, target_height):
+def encode_video(input_path, output_path, target_height, encoder, encoder_options):
     command = [
         "HandBrakeCLI",
         "-i", input_path,
         "-o", output_path,
         "-f", "mkv",
-        "-e", "x265",
-        "--encoder-preset", "slow",
-        "-q", "22",
+        "-e", encoder,
+        *encoder_options,
         "--cfr",
         "--height", str(target_height),
         "--keep-display-aspect",  # Ensures the aspect ratio is maintained
@@ -98,14 +170,17 @@ def encode_video(input_path, output_path, target_height):
     ]
     subprocess.run(command, check=True)
 
-def merge_tracks(encoded_video, original_file, final_output, output_folder):
-    tracks_info = get_tracks_info(original_file)
+def merge_tracks(encoded_video, original_file, final_output, tracks_info):
+    # Start building the mkvmerge command with the output file
+    command = ["mkvmerge", "-o", final_output]
 
-    # Start building the mkvmerge command with the output file and video track exclusion
-    command = ["mkvmerge", "-o", final_output] + ["--no-video"]
+    # Without an encoded video, the original video track is kept as is
+    if encoded_video:
+        # Take only the newly encoded video track from the encoded file
+        command.extend(["--no-audio", "--no-subtitles", encoded_video])
 
-    # Add the encoded video
-    command.append(encoded_video)
+        # Exclude the original video track
+        command.append("--no-video")
 
     # Add audio tracks if they exist
     if tracks_info['audio']:
@@ -125,23 +200,77 @@ def merge_tracks(encoded_video, original_file, final_output, output_folder):
     # Execute the mkvmerge command and capture stderr
     result = subprocess.run(command, stderr=subprocess.PIPE, text=True)
 
-    # Define the path for the warnings or errors log
-    log_path = os.path.join(output_folder, 'mkvmerge-warnings-errors.log')
-
-    # Get the current date and time in ISO 8601 format
-    current_time = datetime.now().isoformat()
-
     # If there was a warning (exit status of 1), log it to a file in the output folder
     if result.returncode == 1:
-        with open(log_path, 'a') as f:
-            f.write(f"{current_time}: Warning encountered while processing file {original_file}:\n")
-            f.write(result.stderr + "\n")
+        log.warning(f"Warning encountered while processing file {original_file}:\n{result.stderr}")
     # For any other non-zero return code, log the error and raise an exception
     elif result.returncode != 0:
-        with open(log_path, 'a') as f:
-            f.write(f"{current_time}: Error for file {original_file}:\n{result.stderr}\n")
+        log.error(f"Error for file {original_file}:\n{result.stderr}")
         raise subprocess.CalledProcessError(result.returncode, command, output=result.stderr)
 
+def is_hevc(tracks_info):
+    codec = (tracks_info['video_codec'] or '').upper()
+    return tracks_info['height'] is not None and ('HEVC' in codec or 'H.265' in codec)
+
+def transcode_video(filename, input_folder, output_folder, target_height, encoder, encoder_options, encode_slot, stop):
+    # Another job has already failed, so the run is stopping
+    if stop.is_set():
+        return
+
+    input_path = os.path.join(input_folder, filename)
+    base_name = os.path.splitext(filename)[0]
+    final_output_path = os.path.join(output_folder, base_name + '.mkv')
+
+    # Skip encoding if the final file already exists in the output folder
+    if os.path.exists(final_output_path):
+        print(f"Output file {final_output_path} already exists. Skipping...")
+        return
+
+    # Probe the original once; the track IDs are needed when merging
+    tracks_info = get_tracks_info(input_path)
+
+    # Re-encoding a video that is already HEVC at or below the target resolution can
+    # only lose quality, so just remux it
+    if is_hevc(tracks_info) and tracks_info['height'] <= target_height:
+        print(f"{filename} is already HEVC at {tracks_info['height']}p. Remuxing without encoding...")
+        merge_tracks(None, input_path, final_output_path, tracks_info)
+        print(f"Finished processing {filename}.")
+        return
+
+    # Wait for a free encode slot. The slot is released before merging, so the next
+    # file's encode can start while this one is still being muxed.
+    temp_output_path = None
+    try:
+        with encode_slot:
+            # Jobs can be waiting here for a long time, so check again whether the run
+            # is stopping before starting a new encode
+            if stop.is_set():
+                return
+
+            # HandBrake's output has to go through a temp file rather than a pipe:
+            # HandBrake seeks back to finish the Matroska headers, and mkvmerge needs a
+            # seekable input. The name is unique so jobs running at the same time never
+            # share a temp file.
+            temp_fd, temp_output_path = tempfile.mkstemp(dir=output_folder, prefix="temp_" + base_name + "_", suffix='.mkv')
+            os.close(temp_fd)
+
+            print(f"Encoding video track of {filename}...")
+            try:
+                encode_video(input_path, temp_output_path, target_height, encoder, encoder_options)
+            except BaseException:
+                # Set this before the slot is released, so a job waiting for it won't start
+                stop.set()
+                raise
+
+        print(f"Merging encoded video with original audio/subtitles from {filename}...")
+        merge_tracks(temp_output_path, input_path, final_output_path, tracks_info)
+    finally:
+        # Don't leave the temp file behind if the encode or merge failed
+        if temp_output_path:
+            os.remove(temp_output_path)
+
+    print(f"Finished processing {filename}.")
+
 def encode_videos(resolution, input_folder, output_folder):
     target_heights = {
         "480p": 480,
@@ -154,26 +283,65 @@ def encode_videos(resolution, input_folder, output_folder):
         print("Invalid resolution. Choose 480p, 720p, 1080p, or 2160p.")
         sys.exit(1)
 
-    for filename in os.listdir(input_folder):
-        if filename.lower().endswith(('.mp4', '.mkv', '.avi', '.mov', '.flv', '.wmv')):
-            input_path = os.path.join(input_folder, filename)
-            base_name = os.path.splitext(filename)[0]
-            temp_output_path = os.path.join(output_folder, "temp_" + base_name + '.mkv')
-            final_output_path = os.path.join(output_folder, base_name + '.mkv')
+    with os.scandir(input_folder) as entries:
+        filenames = [entry.name for entry in entries
+                     if entry.is_file() and entry.name.lower().endswith(VIDEO_EXTENSIONS)]
 
-            # Skip encoding if the final file already exists in the output folder
-            if os.path.exists(final_output_path):
-                print(f"Output file {final_output_path} already exists. Skipping...")
-                continue
+    # Files with the same base name (e.g. Movie.mp4 and Movie.mkv) would both be saved
+    # as Movie.mkv. Keep the first one, as processing the files one at a time would.
+    # Names are compared case-insensitively since the output folder may be too.
+    output_names = {}
+    for filename in list(filenames):
+        output_name = os.path.splitext(filename)[0].lower()
+        if output_name in output_names:
+            print(f"Skipping {filename}: it has the same output name as {output_names[output_name]}.")
+            filenames.remove(filename)
+        else:
+            output_names[output_name] = filename
 
-            print(f"Encoding video track of {filename}...")
-            encode_video(input_path, temp_output_path, target_height)
+    encoder, encoder_options = detect_encoder()
+    print(f"Using the {encoder} encoder.")
 
-            print(f"Merging encoded video with original audio/subtitles from {filename}...")
-            merge_tracks(input_path, temp_output_path, final_output_path, output_folder)
+    # Run up to encode_workers HandBrake encodes at once, plus one more thread so
+    # that probing and muxing (mostly disk-bound) overlap with the encodes. The
+    # work happens in the HandBrake and mkvmerge processes, so threads are enough.
+    encode_workers = encode_worker_count(encoder)
+    encode_slot = threading.Semaphore(encode_workers)
+    stop = threading.Event()
 
-            os.remove(temp_output_path)
-            print(f"Finished processing {filename}.")
+    # Log messages from all of the threads go through a queue to a single handler that
+    # keeps the log file open for the whole run. The file is only created if
+    # something is logged.
+    log_queue = queue.Queue()
+    file_handler = logging.FileHandler(os.path.join(output_folder, LOG_FILENAME), delay=True)
+    file_handler.setFormatter(logging.Formatter('%(asctime)s: %(message)s', datefmt='%Y-%m-%dT%H:%M:%S'))
+    listener = QueueListener(log_queue, file_handler)
+    queue_handler = QueueHandler(log_queue)
+    log.addHandler(queue_handler)
+    listener.start()
+
+    try:
+        with ThreadPoolExecutor(max_workers=encode_workers + 1) as executor:
+            futures = [executor.submit(transcode_video, filename, input_folder, output_folder, target_height,
+                                       encoder, encoder_options, encode_slot, stop)
+                       for filename in filenames]
+            try:
+                # Stop at the first failure in any job, like processing the files one
+                # by one would. Files that haven't started yet are cancelled, jobs
+                # waiting for an encode slot return without encoding, and encodes
+                # already running are left to finish.
+                done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+                for future in done:
+                    future.result()
+            except BaseException:
+                stop.set()
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        listener.stop()
+        log.removeHandler(queue_handler)
+        file_handler.close()
 
 if __name__ == "__main__":
     if len(sys.argv) != 4: